@@ -1,13 +1,24 @@
 # app.py
 import streamlit as st
-from engine import get_engine, map_nhanes_row
-import pandas as pd
+from engine import get_engine
 
 st.set_page_config(page_title="T2DM Treatment Expert System", layout="centered")
 st.title("Explainable Expert System — Type 2 Diabetes Treatment")
 
 st.markdown("Enter patient data (optional fields can be left blank). Click **Get Recommendation** to view the suggested treatment. Click **Show Explanation** to reveal guideline-based reasoning and guideline text.")
 
+# Build the rule engine once per process and share it across reruns/sessions.
+# The returned engine is shared state: never mutate its rules.
+@st.cache_resource
+def get_cached_engine():
+    return get_engine()
+
+# Identical submissions reuse the earlier result; bounded so it cannot grow
+# without limit. cache_data hands back an unpickled copy of the result.
+@st.cache_data(ttl="15m", max_entries=512)
+def evaluate_cached(patient_items):
+    return get_cached_engine().evaluate(dict(patient_items))
+
 # Small helper to transform empty strings to None
 def maybe_none(val):
     if val is None:
@@ -16,71 +27,80 @@ def maybe_none(val):
         return None
     return val
 
+# Widget values keyed by the form value names in _FORM_SCHEMA
+values = {}
 with st.form("patient_form"):
     col1, col2 = st.columns(2)
     with col1:
-        age = st.number_input("Age (years)", min_value=0, max_value=120, value=60)
-        bmi = st.number_input("BMI (kg/m^2) (optional)", min_value=0.0, max_value=100.0, value=28.0, step=0.1)
-        have_diabetes = st.checkbox("Patient has diagnosed Type 2 Diabetes", value=True)
-        hbA1c = st.text_input("HbA1c (%) (optional)", value="7.5")
-        fasting_glu = st.text_input("Fasting glucose (mg/dL) (optional)", value="")
-        ogtt = st.text_input("2-hr OGTT (mg/dL) (optional)", value="")
+        values["age"] = st.number_input("Age (years)", min_value=0, max_value=120, value=60)
+        values["bmi"] = st.number_input("BMI (kg/m^2) (optional)", min_value=0.0, max_value=100.0, value=28.0, step=0.1)
+        values["have_diabetes"] = st.checkbox("Patient has diagnosed Type 2 Diabetes", value=True)
+        values["hbA1c"] = st.text_input("HbA1c (%) (optional)", value="7.5")
+        values["fasting_glu"] = st.text_input("Fasting glucose (mg/dL) (optional)", value="")
+        values["ogtt"] = st.text_input("2-hr OGTT (mg/dL) (optional)", value="")
     with col2:
-        egfr = st.text_input("eGFR (ml/min/1.73m^2) (optional)", value="")
-        albumin = st.text_input("Urine albumin (mg/L) (optional)", value="")
-        creat = st.text_input("Serum creatinine (mg/dL) (optional)", value="")
-        ldl = st.text_input("LDL (mg/dL) (optional)", value="")
+        values["egfr"] = st.text_input("eGFR (ml/min/1.73m^2) (optional)", value="")
+        values["albumin"] = st.text_input("Urine albumin (mg/L) (optional)", value="")
+        values["creat"] = st.text_input("Serum creatinine (mg/dL) (optional)", value="")
+        values["ldl"] = st.text_input("LDL (mg/dL) (optional)", value="")
     st.write("Comorbidities / meds (check boxes or enter text):")
     col3, col4 = st.columns(2)
     with col3:
-        hf = st.checkbox("History of heart failure (HF)")
-        chd = st.checkbox("Coronary heart disease (CHD)")
-        mi = st.checkbox("History of myocardial infarction (MI)")
-        stroke = st.checkbox("History of stroke")
+        values["hf"] = st.checkbox("History of heart failure (HF)")
+        values["chd"] = st.checkbox("Coronary heart disease (CHD)")
+        values["mi"] = st.checkbox("History of myocardial infarction (MI)")
+        values["stroke"] = st.checkbox("History of stroke")
     with col4:
-        liver = st.checkbox("History of liver condition (MASLD/MASH)")
-        on_insulin = st.checkbox("Currently on insulin")
-        on_pills = st.checkbox("Taking diabetic pills")
-        rxddrug = st.text_input("Current medications (comma-separated, e.g., metformin, liraglutide)", value="")
-    cost_barrier = st.checkbox("Cost / access barrier (if yes, system will consider lower-cost options)")
+        values["liver"] = st.checkbox("History of liver condition (MASLD/MASH)")
+        values["on_insulin"] = st.checkbox("Currently on insulin")
+        values["on_pills"] = st.checkbox("Taking diabetic pills")
+        values["rxddrug"] = st.text_input("Current medications (comma-separated, e.g., metformin, liraglutide)", value="")
+    values["cost_barrier"] = st.checkbox("Cost / access barrier (if yes, system will consider lower-cost options)")
     # Optional flags clinicians may want to enter
-    catabolic = st.checkbox("Evidence of catabolism (weight loss, ketosis, hypertriglyceridemia)")
-    frequent_hypo = st.checkbox("Frequent hypoglycemia (flag)")
+    values["catabolic"] = st.checkbox("Evidence of catabolism (weight loss, ketosis, hypertriglyceridemia)")
+    values["frequent_hypo"] = st.checkbox("Frequent hypoglycemia (flag)")
 
     submitted = st.form_submit_button("Get Recommendation")
 
 # Map inputs to engine keys, allow empty -> None
-def build_patient_dict():
-    patient = {
-        "age": age,
-        "bmi": maybe_none(bmi),
-        "lbxgh": maybe_none(hbA1c) if hbA1c != "" else None,
-        "lbxglu": maybe_none(fasting_glu) if fasting_glu != "" else None,
-        "lbxglt": maybe_none(ogtt) if ogtt != "" else None,
-        "vnegfr": maybe_none(egfr) if egfr != "" else None,
-        "urxums": maybe_none(albumin) if albumin != "" else None,
-        "lbxscr": maybe_none(creat) if creat != "" else None,
-        "lbdldl": maybe_none(ldl) if ldl != "" else None,
-        "mcq160b": 1 if hf else 0,
-        "mcq160c": 1 if chd else 0,
-        "mcq160e": 1 if mi else 0,
-        "mcq160f": 1 if stroke else 0,
-        "mcq160l": 1 if liver else 0,
-        "diq010": 1 if have_diabetes else 0,
-        "diq050": 1 if on_insulin else 0,
-        "diq070": 1 if on_pills else 0,
-        "rxddrug": rxddrug.lower(),
-        "cost_barrier": 1 if cost_barrier else 0,
-        "catabolic_signs": True if catabolic else False,
-        "frequent_hypoglycemia": 1 if frequent_hypo else 0
-    }
-    return patient
+def as_flag(v):
+    return 1 if v else 0
 
-if submitted:
-    patient = build_patient_dict()
-    engine = get_engine()
-    recs, expl = engine.evaluate(patient)
+def as_is(v):
+    return v
+
+# (engine key, form value name, converter)
+_FORM_SCHEMA = (
+    ("age", "age", as_is),
+    ("bmi", "bmi", maybe_none),
+    ("lbxgh", "hbA1c", maybe_none),
+    ("lbxglu", "fasting_glu", maybe_none),
+    ("lbxglt", "ogtt", maybe_none),
+    ("vnegfr", "egfr", maybe_none),
+    ("urxums", "albumin", maybe_none),
+    ("lbxscr", "creat", maybe_none),
+    ("lbdldl", "ldl", maybe_none),
+    ("mcq160b", "hf", as_flag),
+    ("mcq160c", "chd", as_flag),
+    ("mcq160e", "mi", as_flag),
+    ("mcq160f", "stroke", as_flag),
+    ("mcq160l", "liver", as_flag),
+    ("diq010", "have_diabetes", as_flag),
+    ("diq050", "on_insulin", as_flag),
+    ("diq070", "on_pills", as_flag),
+    ("rxddrug", "rxddrug", str.lower),
+    ("cost_barrier", "cost_barrier", as_flag),
+    ("catabolic_signs", "catabolic", bool),
+    ("frequent_hypoglycemia", "frequent_hypo", as_flag),
+)
 
+def build_patient_dict(values):
+    return {key: conv(values[src]) for key, src, conv in _FORM_SCHEMA}
+
+# Results render in a fragment so interactions inside it rerun only this block,
+# not the whole form; the last evaluation is kept in session state.
+@st.fragment
+def render_results(recs, expl):
     st.subheader("Treatment Recommendation")
     if len(recs) == 0:
         st.info(
@@ -111,3 +131,9 @@ if submitted:
                         st.info(e["guideline_text"])
                     st.markdown("---")
 
+if submitted:
+    patient = build_patient_dict(values)
+    st.session_state["results"] = evaluate_cached(tuple(sorted(patient.items())))
+
+if "results" in st.session_state:
+    render_results(*st.session_state["results"])
@@ -3,103 +3,564 @@
 Expert rule engine for T2DM treatment recommendations with dosage guidance.
 - Rules are based on ADA 2025 pharmacologic strategy (user-provided).
 - Each Rule includes dosage and dosage_reason fields and optional guideline_text.
+- Rule conditions are declarative guards compiled once when the rule is built.
+- The engine turns its rules into one generated dispatch function (compile_rules).
 - Safe handling of missing inputs (None).
 """
-from dataclasses import dataclass, field
-from typing import Callable, Dict, Any, List, Tuple, Optional
+import math
+import operator
+import re
+import sys
+from dataclasses import dataclass, field, fields
+from typing import TYPE_CHECKING, Callable, Dict, Any, FrozenSet, List, Tuple, Optional, cast
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 def safe_num(x: Any) -> Optional[float]:
-    """Convert input to float if possible; return None for empty/invalid."""
+    """Convert input to float if possible; return None for empty/invalid/NaN."""
     try:
         if x is None:
             return None
         if isinstance(x, (int, float)):
-            return float(x)
-        s = str(x).strip()
-        if s == "":
-            return None
-        return float(s)
+            v = float(x)
+        else:
+            s = str(x).strip()
+            if s == "":
+                return None
+            v = float(s)
+        # pandas/NHANES encode missing numbers as NaN
+        return None if math.isnan(v) else v
     except Exception:
         return None
 
+def is_na(x: Any) -> bool:
+    """True for the missing-value markers None, NaN and pandas.NA."""
+    if x is None:
+        return True
+    try:
+        return bool(x != x)
+    except TypeError:
+        # pandas.NA refuses to be coerced to bool
+        return True
+
+_TRUTHY_STRINGS = frozenset({"1", "yes", "Yes", "YES", "Y", "y", "true", "True"})
+
 def truthy_flag(x: Any) -> bool:
     """Interpret many possible truthy values returned by NHANES or UI."""
-    return x in (1, True, "1", "yes", "Yes", "YES", "Y", "y", "true", "True")
+    if isinstance(x, str):
+        return x in _TRUTHY_STRINGS
+    # 1, 1.0, True and their NumPy counterparts
+    try:
+        return x is True or bool(x == 1)
+    except TypeError:
+        # pandas.NA (nullable dtypes) compares to NA, which has no truth value
+        return False
 
-@dataclass
+# ---------- Declarative rule conditions ----------
+# A guard is (patient key, op, operand). A clause holds when all of its guards
+# hold; a rule fires when any of its clauses holds (an empty clause always holds).
+Guard = Tuple[str, str, Any]
+Clause = Tuple[Guard, ...]
+
+# Patient keys read as numbers; parsed once per patient by _coerce().
+NUMERIC_KEYS = ("lbxgh", "lbxsgl", "lbxglu", "lbxglt", "vnegfr", "urxums", "urxuma",
+                "bmi", "bedtime_mgdl", "morning_mgdl")
+
+def is_given(x: Any) -> bool:
+    """Whether a raw value counts as filled in, as in `a or b`; NaN/pandas.NA do not."""
+    return not is_na(x) and bool(x)
+
+def _first_given(patient: Dict[str, Any], ctx: Dict[str, Any], keys: Tuple[str, ...]) -> Optional[float]:
+    """Parsed value of the first key whose raw value is filled in (a blank or
+    unparseable reading does not fall through to the next key)."""
+    for k in keys:
+        if is_given(patient.get(k)):
+            value: Optional[float] = ctx[k]
+            return value
+    return None
+
+def _difference(patient: Dict[str, Any], ctx: Dict[str, Any], keys: Tuple[str, ...]) -> Optional[float]:
+    a: Optional[float] = ctx[keys[0]]
+    b: Optional[float] = ctx[keys[1]]
+    if a is None or b is None:
+        return None
+    return a - b
+
+# combiner(patient, ctx, source keys) -> derived value
+COMBINERS: Dict[str, Callable[[Dict[str, Any], Dict[str, Any], Tuple[str, ...]], Optional[float]]] = {
+    "first": _first_given,
+    "difference": _difference,
+}
+
+# Numeric features computed from other numeric keys; guards reference them by name.
+# name -> (combiner, source keys)
+DERIVED_FEATURES: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "glucose": ("first", ("lbxsgl", "lbxglu", "lbxglt")),
+    "albumin": ("first", ("urxums", "urxuma")),
+    "bedtime_delta": ("difference", ("bedtime_mgdl", "morning_mgdl")),
+}
+
+# Free-text medication keys, scanned once per patient for the drug names rules ask about
+DRUG_KEYS = ("rxddrug",)
+DRUG_NAMES = ("metformin",)
+# Substring search, so "MetforminER" or "metformin500mg" still count as metformin
+_DRUG_PATTERN = re.compile("|".join(map(re.escape, DRUG_NAMES)))
+
+def drug_set(x: Any) -> FrozenSet[str]:
+    """Known drug names mentioned in a medication list, e.g. "Glyburide; Metformin HCl" -> {metformin}."""
+    # Only text is a medication list; None/NaN/pandas.NA mean no medications
+    return frozenset(_DRUG_PATTERN.findall(x.lower())) if isinstance(x, str) else frozenset()
+
+def _coerce(patient: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Per-patient context read by guards: parsed numbers for NUMERIC_KEYS and
+    DERIVED_FEATURES, drug-name sets for DRUG_KEYS.
+    """
+    ctx: Dict[str, Any] = {k: safe_num(patient.get(k)) for k in NUMERIC_KEYS}
+    for k in DRUG_KEYS:
+        ctx[k] = drug_set(patient.get(k))
+    for name, (combiner, keys) in DERIVED_FEATURES.items():
+        ctx[name] = COMBINERS[combiner](patient, ctx, keys)
+    return ctx
+
+# None-safe comparisons: a missing/invalid number never matches.
+def gt(a: Optional[float], b: float) -> bool:
+    return a is not None and a > b
+
+def ge(a: Optional[float], b: float) -> bool:
+    return a is not None and a >= b
+
+def lt(a: Optional[float], b: float) -> bool:
+    return a is not None and a < b
+
+def le(a: Optional[float], b: float) -> bool:
+    return a is not None and a <= b
+
+def is_missing(a: Optional[float], _: Any) -> bool:
+    return a is None
+
+def flag_is(x: Any, want: bool) -> bool:
+    return truthy_flag(x) is want
+
+def lacks_drug(drugs: FrozenSet[str], drug: str) -> bool:
+    return drug not in drugs
+
+# Ops applied to the coerced context rather than the raw patient value.
+NUMERIC_OPS = frozenset({"gt", "ge", "lt", "le", "missing"})
+DRUG_OPS = frozenset({"has_drug", "lacks_drug"})
+
+# Module-level functions only (no lambdas/closures), so compiled rules pickle
+# cleanly, e.g. for multiprocessing batch scoring.
+GUARD_OPS: Dict[str, Callable[[Any, Any], bool]] = {
+    "gt": gt,
+    "ge": ge,
+    "lt": lt,
+    "le": le,
+    "missing": is_missing,
+    "flag": flag_is,
+    "is": operator.is_,
+    "has_drug": operator.contains,
+    "lacks_drug": lacks_drug,
+}
+
+# Context values of a patient with no data; used to probe guards on missing input
+_MISSING_CTX = _coerce({})
+
+# (key, reads coerced context, test, operand)
+CompiledGuard = Tuple[str, bool, Callable[[Any, Any], bool], Any]
+
+def compile_clauses(when: Tuple[Clause, ...]) -> Tuple[Tuple[CompiledGuard, ...], ...]:
+    """Resolve guard op names and value sources once, ahead of evaluation."""
+    compiled = []
+    for clause in when:
+        guards = []
+        for key, op, operand in clause:
+            if op not in GUARD_OPS:
+                raise ValueError(f"Unknown guard op {op!r} on key {key!r}")
+            numeric = key in NUMERIC_KEYS or key in DERIVED_FEATURES
+            if numeric != (op in NUMERIC_OPS) or (key in DRUG_KEYS) != (op in DRUG_OPS):
+                raise ValueError(f"Guard op {op!r} cannot be applied to key {key!r}")
+            if op in DRUG_OPS and operand not in DRUG_NAMES:
+                raise ValueError(f"Unknown drug {operand!r}; add it to DRUG_NAMES")
+            guards.append((key, key in _MISSING_CTX, GUARD_OPS[op], operand))
+        compiled.append(tuple(guards))
+    return tuple(compiled)
+
+# Guard tests are total (None-safe, never raise), so no exception handling is
+# needed around rule evaluation.
+def _holds(clauses: Tuple[Tuple[CompiledGuard, ...], ...], patient: Dict[str, Any],
+           ctx: Dict[str, Any]) -> bool:
+    for clause in clauses:
+        for key, coerced, test, operand in clause:
+            if not test(ctx[key] if coerced else patient.get(key), operand):
+                break
+        else:
+            return True
+    return False
+
+class ReadOnlyDict(Dict[str, str]):
+    """
+    A dict that cannot be changed after construction. Still a plain dict to
+    json.dumps, pickle and multiprocessing.
+    """
+    def _read_only(self) -> TypeError:
+        return TypeError(f"{self.__class__.__name__} is read-only")
+
+    def __setitem__(self, key: str, value: str) -> None:
+        raise self._read_only()
+
+    def __delitem__(self, key: str) -> None:
+        raise self._read_only()
+
+    def __ior__(self, other: Any) -> Any:  # type: ignore[misc]  # never returns
+        raise self._read_only()
+
+    def clear(self, *args: Any, **kwargs: Any) -> Any:
+        raise self._read_only()
+
+    def pop(self, *args: Any, **kwargs: Any) -> Any:
+        raise self._read_only()
+
+    def popitem(self, *args: Any, **kwargs: Any) -> Any:
+        raise self._read_only()
+
+    def setdefault(self, *args: Any, **kwargs: Any) -> Any:
+        raise self._read_only()
+
+    def update(self, *args: Any, **kwargs: Any) -> Any:
+        raise self._read_only()
+
+    def __reduce__(self) -> Tuple[type, Tuple[Dict[str, str]]]:
+        # Rebuild from a plain copy; the default dict pickling would call __setitem__
+        return (self.__class__, (dict(self),))
+
+@dataclass(slots=True)
 class Rule:
     id: str
     description: str
-    condition: Callable[[Dict[str, Any]], bool]  # function(patient) -> bool
+    when: Tuple[Clause, ...]  # any-of clauses, each an all-of tuple of guards
     recommendation: str
     dosage: str = ""          # human-readable dosage guidance
     dosage_reason: str = ""   # why this dosage / titration is recommended
     priority: int = 100       # lower numbers = higher priority
     guideline_ref: str = ""
     guideline_text: str = ""
+    requires_diabetes: bool = True  # only considered for patients with diq010 set
+    exclusive: bool = False   # when fired, lower-priority rules are not evaluated
+    # Threshold-specific wording, checked in order once the rule has matched; the
+    # first variant whose `when` holds replaces this rule's text in the output
+    variants: Tuple["Rule", ...] = ()
+    _clauses: Tuple[Tuple[CompiledGuard, ...], ...] = field(init=False, repr=False, compare=False)
+    _explain: ReadOnlyDict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self._clauses = compile_clauses(self.when)
+        # Short labels repeat across rules and results; share one copy of each
+        self.id = sys.intern(self.id)
+        self.guideline_ref = sys.intern(self.guideline_ref)
+        # Explanation payload handed to the UI; built once and read-only, so every
+        # result references the same mapping
+        self._explain = ReadOnlyDict({
+            "id": self.id,
+            "description": self.description,
+            "recommendation": self.recommendation,
+            "dosage": self.dosage,
+            "dosage_reason": self.dosage_reason,
+            "guideline_ref": self.guideline_ref,
+            "guideline_text": self.guideline_text,
+        })
+
+    def __reduce__(self) -> Tuple[type, Tuple[Any, ...]]:
+        # Derived fields (compiled guards, read-only explanation) are rebuilt on unpickling
+        return (self.__class__, tuple(getattr(self, f.name) for f in fields(self) if f.init))
+
+    def resolve(self, patient: Dict[str, Any], ctx: Dict[str, Any]) -> "Rule":
+        """The rule or variant whose text describes this (already matched) patient."""
+        for v in self.variants:
+            if _holds(v._clauses, patient, ctx):
+                return v
+        return self
 
-    def applies(self, patient: Dict[str, Any]) -> bool:
-        try:
-            return bool(self.condition(patient))
-        except Exception:
+    def applies(self, patient: Dict[str, Any], ctx: Dict[str, Any]) -> bool:
+        """Check one rule; ctx is _coerce(patient), computed once by the caller."""
+        if self.requires_diabetes and not truthy_flag(patient.get("diq010")):
             return False
+        return _holds(self._clauses, patient, ctx)
+
+# Source templates for guards in generated dispatch code; {v} is the local
+# holding the guarded value, {o} the operand literal
+_GUARD_SOURCE = {
+    "gt": "{v} is not None and {v} > {o}",
+    "ge": "{v} is not None and {v} >= {o}",
+    "lt": "{v} is not None and {v} < {o}",
+    "le": "{v} is not None and {v} <= {o}",
+    "missing": "{v} is None",
+    "flag": "truthy_flag({v}) is {o}",
+    "is": "{v} is {o}",
+    "has_drug": "{o} in {v}",
+    "lacks_drug": "{o} not in {v}",
+}
+
+# dispatch(patient, ctx) -> fired rules, resolved to their variants
+Dispatch = Callable[[Dict[str, Any], Dict[str, Any]], Tuple[Rule, ...]]
+
+def compile_rules(rules: List[Rule]) -> Dispatch:
+    """
+    Generate one Python function that checks every rule in order (rules must be
+    sorted by priority) and returns the fired rules, resolved to their variants,
+    as ExpertEngine._fired() does. The generated code is kept in the returned
+    function's `source` attribute; traceback line numbers in "<rules>" index it.
+    """
+    names: Dict[Tuple[bool, str], str] = {}
+    consts: Dict[str, Any] = {"truthy_flag": truthy_flag}
+
+    def local(key: str) -> str:
+        coerced = key in _MISSING_CTX
+        if (coerced, key) not in names:
+            names[coerced, key] = f"v{len(names)}"
+        return names[coerced, key]
+
+    def literal(value: Any) -> str:
+        # Plain literals inline; anything else is passed in as a constant
+        if value is None or type(value) in (bool, int, float, str):
+            return repr(value)
+        name = f"c{len(consts)}"
+        consts[name] = value
+        return name
+
+    def condition(when: Tuple[Clause, ...]) -> str:
+        # Guard templates only use `and`/comparisons, so no parentheses are needed
+        clauses = [
+            " and ".join(_GUARD_SOURCE[op].format(v=local(key), o=literal(operand))
+                         for key, op, operand in clause) or "True"
+            for clause in when
+        ]
+        return " or ".join(clauses) or "False"
+
+    body: List[str] = []
+    fallback = None
+    for i, r in enumerate(rules):
+        if r.id == "R_FALLBACK":
+            fallback = i
+            continue
+        consts[f"R{i}"] = r
+        test = f"({condition(r.when)})"
+        if r.requires_diabetes:
+            test = f"diagnosed and {test}"
+        # Once an exclusive rule fired, lower-priority rules are skipped
+        body.append(f"    if cutoff >= {r.priority} and {test}:  # {r.id}")
+        for j, v in enumerate(r.variants):
+            consts[f"R{i}_{j}"] = v
+            body.append(f"        {'if' if j == 0 else 'elif'} {condition(v.when)}:")
+            body.append(f"            fired.append(R{i}_{j})")
+        if r.variants:
+            body.append("        else:")
+            body.append(f"            fired.append(R{i})")
+        else:
+            body.append(f"        fired.append(R{i})")
+        if r.exclusive:
+            body.append(f"        cutoff = min(cutoff, {r.priority})")
+    if fallback is not None:
+        consts["FALLBACK"] = rules[fallback]
+        body.append("    if not fired:")
+        body.append("        fired.append(FALLBACK)")
+
+    head = ["def dispatch(patient, ctx):", "    get = patient.get"]
+    head += [f"    {name} = {'ctx[' + repr(key) + ']' if coerced else 'get(' + repr(key) + ')'}"
+             for (coerced, key), name in names.items()]
+    head += ["    diagnosed = truthy_flag(get('diq010'))", "    fired = []", "    cutoff = float('inf')"]
+    source = "\n".join(head + body + ["    return tuple(fired)", ""])
+
+    exec(compile(source, "<rules>", "exec"), consts)
+    dispatch = consts["dispatch"]
+    dispatch.source = source
+    return cast(Dispatch, dispatch)
 
 @dataclass
 class ExpertEngine:
     rules: List[Rule] = field(default_factory=list)
+    # Evaluate through code generated by compile_rules(); False checks the rules
+    # one by one in _fired() (easier to step through when debugging)
+    compiled: bool = True
 
-    def evaluate(self, patient):
-        fired_rules = []
+    def __post_init__(self) -> None:
+        # Keep rules in priority order (stable for ties) so fired rules come out
+        # already sorted and evaluate() never has to sort.
+        self.rules = sorted(self.rules, key=operator.attrgetter("priority"))
+        self._dispatch = compile_rules(self.rules) if self.compiled else self._fired
+
+    def _fired(self, patient: Dict[str, Any], ctx: Dict[str, Any]) -> Tuple[Rule, ...]:
+        """Fired rules, resolved to their matching variant, in priority order."""
+        fired = []
 
         # First evaluate all normal rules EXCEPT fallback
+        # Rules are in priority order: once an exclusive rule fires, stop at the
+        # first rule of lower priority (same-priority rules still apply)
+        cutoff = None
+        diagnosed = truthy_flag(patient.get("diq010"))
         for r in self.rules:
-            if r.id != "R_FALLBACK" and r.applies(patient):
-                fired_rules.append(r)
+            if cutoff is not None and r.priority > cutoff:
+                break
+            if r.id == "R_FALLBACK" or r.requires_diabetes and not diagnosed:
+                continue
+            if _holds(r._clauses, patient, ctx):
+                fired.append(r.resolve(patient, ctx))
+                if r.exclusive and cutoff is None:
+                    cutoff = r.priority
 
         # If nothing fired → use fallback rule
-        if len(fired_rules) == 0:
+        if len(fired) == 0:
             fallback = next((r for r in self.rules if r.id == "R_FALLBACK"), None)
-            if fallback:
-                fired_rules.append(fallback)
+            if fallback is not None:
+                fired.append(fallback)
+
+        return tuple(fired)
+
+    def __reduce__(self) -> Tuple[type, Tuple[List[Rule], bool]]:
+        # The generated dispatch is rebuilt from the rules on unpickling
+        return (self.__class__, (self.rules, self.compiled))
 
-        # Sort by priority
-        fired_rules.sort(key=lambda r: r.priority)
+    def evaluate(self, patient: Dict[str, Any]) -> Tuple[List[str], List[Dict[str, str]]]:
+        # Parse numbers and drug lists once; guards read the parsed values
+        ctx = _coerce(patient)
+        fired_rules = self._dispatch(patient, ctx)
 
-        # Convert to dict for UI
+        # Prebuilt read-only explanation dicts for UI, shared across results
         recs = [r.recommendation for r in fired_rules]
-        expl = [r.__dict__ for r in fired_rules]
+        expl: List[Dict[str, str]] = [r._explain for r in fired_rules]
 
         return recs, expl
 
+    def evaluate_batch(self, df: "pd.DataFrame") -> "pd.DataFrame":
+        """
+        Vectorized evaluate() for scoring a whole dataset. `df` columns are engine
+        keys (rename NHANES columns with NHANES_TO_ENGINE_KEY); absent columns count
+        as missing. Returns a boolean DataFrame with one column per rule id, in
+        priority order, marking the rules that fired for each row.
+        """
+        import numpy as np
+        import pandas as pd
+
+        n = len(df)
+        absent = pd.Series([None] * n, index=df.index, dtype=object)
+
+        def column(k: str) -> "pd.Series":
+            return df[k] if k in df.columns else absent
+
+        def as_float(k: str) -> Optional[np.ndarray]:
+            """Float view (NaN for missing) of a numeric-dtype or absent column, else None."""
+            if k not in df.columns:
+                return np.full(n, np.nan)
+            if pd.api.types.is_numeric_dtype(df[k]):
+                x: np.ndarray = df[k].to_numpy(dtype=np.float64, na_value=np.nan)
+                return x
+            return None
+
+        def first_given(keys: Tuple[str, ...]) -> np.ndarray:
+            out = np.full(n, np.nan)
+            for k in reversed(keys):
+                x = as_float(k)
+                if x is not None:
+                    given = ~np.isnan(x) & (x != 0)
+                else:
+                    given = column(k).map(is_given).to_numpy(dtype=bool)
+                out = np.where(given, nums[k], out)
+            return out
+
+        def difference(keys: Tuple[str, ...]) -> np.ndarray:
+            delta: np.ndarray = nums[keys[0]] - nums[keys[1]]
+            return delta
+
+        # Array counterparts of COMBINERS; NaN propagates as missing
+        combiners = {"first": first_given, "difference": difference}
+
+        # Numeric view as float arrays, NaN for missing/invalid
+        nums: Dict[str, np.ndarray] = {}
+        for k in NUMERIC_KEYS:
+            x = as_float(k)
+            nums[k] = x if x is not None else column(k).map(safe_num).to_numpy(dtype=np.float64, na_value=np.nan)
+        for name, (combiner, keys) in DERIVED_FEATURES.items():
+            nums[name] = combiners[combiner](keys)
+
+        comparisons = {"gt": np.greater, "ge": np.greater_equal, "lt": np.less, "le": np.less_equal}
+        masks: Dict[Guard, np.ndarray] = {}
+
+        def guard_mask(guard: Guard) -> np.ndarray:
+            if guard not in masks:
+                key, op, operand = guard
+                if op == "missing":
+                    masks[guard] = np.isnan(nums[key])
+                elif op in comparisons:
+                    masks[guard] = comparisons[op](nums[key], operand)
+                elif op == "has_drug":
+                    # Same as drug_set(): only text counts, matched as a lowercase substring
+                    has = column(key).str.lower().str.contains(operand, regex=False)
+                    masks[guard] = has.to_numpy(dtype=bool, na_value=False)
+                elif op == "lacks_drug":
+                    masks[guard] = ~guard_mask((key, "has_drug", operand))
+                elif (x := as_float(key)) is not None and (op == "flag" or op == "is" and type(operand) is bool):
+                    if op == "flag":
+                        # truthy_flag() of a number: equal to 1, NaN/NA never
+                        masks[guard] = (x == 1) == operand
+                    elif pd.api.types.is_bool_dtype(column(key)):
+                        masks[guard] = x == operand
+                    else:
+                        # Non-bool numbers are never `is True`/`is False`
+                        masks[guard] = np.zeros(n, dtype=bool)
+                else:
+                    # Object/string columns apply the scalar test once per row;
+                    # tolist() yields Python scalars, matching what evaluate() sees
+                    test = GUARD_OPS[op]
+                    values = column(key).tolist()
+                    masks[guard] = np.fromiter((test(v, operand) for v in values), dtype=bool, count=n)
+            return masks[guard]
+
+        diabetic = guard_mask(("diq010", "flag", True))
+        fired: Dict[str, np.ndarray] = {}
+        any_fired = np.zeros(n, dtype=bool)
+        # Per-row priority cutoff set by the first exclusive rule that fired
+        cutoff = np.full(n, np.inf)
+        for r in self.rules:
+            if r.id == "R_FALLBACK":
+                continue
+            mask = np.zeros(n, dtype=bool)
+            for clause in r.when:
+                clause_mask = np.ones(n, dtype=bool)
+                for guard in clause:
+                    clause_mask &= guard_mask(guard)
+                mask |= clause_mask
+            if r.requires_diabetes:
+                mask &= diabetic
+            mask &= r.priority <= cutoff
+            if r.exclusive:
+                cutoff = np.where(mask, np.minimum(cutoff, r.priority), cutoff)
+            fired[r.id] = mask
+            any_fired |= mask
+
+        # Fallback fires wherever nothing else did
+        if any(r.id == "R_FALLBACK" for r in self.rules):
+            fired["R_FALLBACK"] = ~any_fired
+        return pd.DataFrame(fired, index=df.index)[[r.id for r in self.rules]]
+
 # ---------- Rule definitions based on provided ADA guidance ----------
 def make_ada_rules() -> List[Rule]:
     rules: List[Rule] = []
 
-    # Helper lambdas for readability
-    get_a1c = lambda p: safe_num(p.get("lbxgh"))
-    get_glucose = lambda p: safe_num(p.get("lbxsgl") or p.get("lbxglu") or p.get("lbxglt"))
-    get_eGFR = lambda p: safe_num(p.get("vnegfr"))
-    get_albumin = lambda p: safe_num(p.get("urxums") or p.get("urxuma"))
-    get_bmi = lambda p: safe_num(p.get("bmi"))
-    on_metformin = lambda p: "metformin" in (str(p.get("rxddrug") or "").lower())
-    on_insulin = lambda p: truthy_flag(p.get("diq050"))
-    have_diabetes = lambda p: truthy_flag(p.get("diq010"))
-
     # ----- Insulin initiation for severe hyperglycemia (highest priority) -----
     rules.append(Rule(
         id="R_INSULIN_SEVERE",
         description="Severe hyperglycemia or catabolism -> suggest initiating insulin.",
-        condition=lambda p: (
-            have_diabetes(p) and (
-                (get_a1c(p) is not None and get_a1c(p) > 10.0) or
-                (get_glucose(p) is not None and get_glucose(p) >= 300.0) or
-                (p.get("catabolic_signs") is True)
-            )
+        when=(
+            (("lbxgh", "gt", 10.0),),
+            (("glucose", "ge", 300.0),),
+            (("catabolic_signs", "is", True),),
         ),
         recommendation="Initiate insulin therapy (basal-first strategy).",
         dosage="Start basal insulin 10 units once daily or 0.1–0.2 units/kg/day; titrate every 3 days by 10% or 2–4 units until fasting glucose target reached.",
         dosage_reason="Start low to reduce hypoglycemia risk; weight-based initial dose provides reasonable starting point; titrate frequently until morning targets are achieved.",
         priority=1,
+        exclusive=True,
         guideline_ref="ADA 5.1, 9.23",
         guideline_text="Initiate insulin when A1C >10% or plasma glucose ≥300 mg/dL, or clinical features of catabolism. Titrate per fasting glucose targets and patient safety."
     ))
@@ -108,49 +569,50 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_METFORMIN_CONTRA",
         description="Metformin contraindication or caution based on eGFR thresholds.",
-        condition=lambda p: have_diabetes(p) and (get_eGFR(p) is not None and get_eGFR(p) < 30.0),
+        when=((("vnegfr", "lt", 30.0),),),
         recommendation="Avoid initiating metformin; stop metformin if eGFR <30.",
         dosage="Do not start; if current user has eGFR <30 stop metformin. If eGFR 30–45 consider dose reduction (e.g., 500–1000 mg/day) and monitoring.",
         dosage_reason="Reduced renal clearance increases risk of lactic acidosis; dose adjustments or discontinuation per renal function.",
         priority=2,
+        exclusive=True,
         guideline_ref="ADA metformin & CKD",
         guideline_text="Avoid initiating metformin if eGFR <45 mL/min/1.73 m2 and stop if <30; adjust dosing and monitor renal function."
     ))
 
-    # ----- Advanced CKD prefer GLP-1 RA (when SGLT2 glycemic effect reduced) -----
-    rules.append(Rule(
-        id="R_CKD_ADVANCED",
-        description="Advanced CKD (eGFR <30) -> prefer GLP-1 RA for glycemic/weight benefit.",
-        condition=lambda p: have_diabetes(p) and (get_eGFR(p) is not None and get_eGFR(p) < 30.0),
-        recommendation="Prefer GLP-1 receptor agonist (e.g., semaglutide) when glycemic therapy needed; avoid relying on SGLT2i for glycemic lowering.",
-        dosage="Semaglutide: start 0.25 mg weekly → increase to 0.5 mg weekly after 4 weeks → target 1.0 mg weekly (label-specific titration). Check product label for renal dosing adjustments as required.",
-        dosage_reason="GLP-1 RAs retain efficacy for glycemia/weight in low eGFR and have lower hypoglycemia risk vs insulin/SU; titration reduces GI side effects.",
-        priority=2,
-        guideline_ref="ADA 9.14",
-        guideline_text="In advanced CKD (eGFR <30), GLP-1 RAs are preferred for glycemic management due to lower hypoglycemia risk and cardiovascular/renal benefits."
-    ))
-
-    # ----- CKD with albuminuria or moderate eGFR decline: prefer SGLT2i (if eGFR allows) or GLP-1 -----
+    # ----- CKD: SGLT2i or GLP-1 RA; in advanced CKD (eGFR <30) prefer GLP-1 RA -----
     rules.append(Rule(
-        id="R_CKD_ALBUMINURIA",
+        id="R_CKD",
         description="CKD with albuminuria or moderate eGFR decline -> SGLT2i or GLP-1 RA with kidney benefit.",
-        condition=lambda p: have_diabetes(p) and (
-            (get_eGFR(p) is not None and 20.0 <= get_eGFR(p) <= 60.0) or
-            (get_albumin(p) is not None and get_albumin(p) > 30.0)
+        when=(
+            (("vnegfr", "le", 60.0),),
+            (("albumin", "gt", 30.0),),
         ),
         recommendation="Use SGLT2 inhibitor if eGFR adequate; consider GLP-1 RA if SGLT2i not suitable or additional weight benefit is desired.",
         dosage="Empagliflozin 10 mg daily or Dapagliflozin 10 mg daily (follow label for minimum eGFR cutoffs and continuation criteria).",
         dosage_reason="SGLT2 inhibitors at standard doses reduce CKD progression and heart failure events when eGFR is within label-allowed range; use GLP-1 RA when SGLT2i not tolerated or for weight benefit.",
-        priority=3,
+        priority=2,
         guideline_ref="ADA 9.13",
-        guideline_text="In T2D with CKD (eGFR 20–60 and/or albuminuria), SGLT2 inhibitors or GLP-1 RAs with proven kidney benefit are recommended."
+        guideline_text="In T2D with CKD (eGFR 20–60 and/or albuminuria), SGLT2 inhibitors or GLP-1 RAs with proven kidney benefit are recommended.",
+        variants=(
+            Rule(
+                id="R_CKD",
+                description="Advanced CKD (eGFR <30) -> prefer GLP-1 RA for glycemic/weight benefit.",
+                when=((("vnegfr", "lt", 30.0),),),
+                recommendation="Prefer GLP-1 receptor agonist (e.g., semaglutide) when glycemic therapy needed; avoid relying on SGLT2i for glycemic lowering.",
+                dosage="Semaglutide: start 0.25 mg weekly → increase to 0.5 mg weekly after 4 weeks → target 1.0 mg weekly (label-specific titration). Check product label for renal dosing adjustments as required.",
+                dosage_reason="GLP-1 RAs retain efficacy for glycemia/weight in low eGFR and have lower hypoglycemia risk vs insulin/SU; titration reduces GI side effects.",
+                priority=2,
+                guideline_ref="ADA 9.14",
+                guideline_text="In advanced CKD (eGFR <30), GLP-1 RAs are preferred for glycemic management due to lower hypoglycemia risk and cardiovascular/renal benefits."
+            ),
+        ),
     ))
 
     # ----- Heart failure -> SGLT2i recommended -----
     rules.append(Rule(
         id="R_HF_SGLT2",
         description="Heart failure (HFrEF or HFpEF) -> recommend SGLT2 inhibitor for HF prevention/management.",
-        condition=lambda p: have_diabetes(p) and truthy_flag(p.get("mcq160b")),
+        when=((("mcq160b", "flag", True),),),
         recommendation="Recommend SGLT2 inhibitor (empagliflozin, dapagliflozin) for HF benefit, if eGFR allows.",
         dosage="Empagliflozin 10 mg daily or Dapagliflozin 10 mg daily; adjust/withhold if below label eGFR threshold per product monograph.",
         dosage_reason="Standard daily dosing provides cardiovascular and renal protection shown in trials; adjust for renal function and follow label.",
@@ -163,7 +625,7 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_ASCVD_CV",
         description="Established ASCVD or high ASCVD risk -> include GLP-1 RA and/or SGLT2i for CV risk reduction.",
-        condition=lambda p: have_diabetes(p) and any(truthy_flag(p.get(k)) for k in ("mcq160c","mcq160e","mcq160f")),
+        when=tuple(((k, "flag", True),) for k in ("mcq160c", "mcq160e", "mcq160f")),
         recommendation="Prioritize GLP-1 receptor agonist and/or SGLT2 inhibitor for CV risk reduction (irrespective of baseline A1C).",
         dosage="GLP-1 RA example: liraglutide start 0.6 mg daily → titrate to 1.2–1.8 mg daily per label. SGLT2i example: empagliflozin 10 mg daily.",
         dosage_reason="Drug classes demonstrated CV event reduction in trials at standard therapeutic doses; follow label titration to reduce side effects.",
@@ -176,7 +638,7 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_OBESITY_WEIGHT",
         description="Obesity as a treatment target -> prioritize high-efficacy weight-loss agents with glucose benefit.",
-        condition=lambda p: have_diabetes(p) and (get_bmi(p) is not None and get_bmi(p) >= 30.0),
+        when=((("bmi", "ge", 30.0),),),
         recommendation="Consider GLP-1 RA (semaglutide, liraglutide) or tirzepatide for combined glycemic and weight benefits.",
         dosage="Semaglutide (Wegovy/Rybelsus vs Ozempic labeling differ): common GLP-1 RA dose for glycemic control: start 0.25 mg weekly → escalate to 0.5 mg then 1.0 mg weekly (per product). Tirzepatide: follow product titration schedule (e.g., start 2.5 mg weekly → escalate).",
         dosage_reason="Gradual escalation improves GI tolerability and achieves weight loss; follow product-specific titration schedules.",
@@ -189,7 +651,7 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_ADD_ON_METFORMIN",
         description="On metformin with inadequate control -> consider add-on based on comorbidities and goals.",
-        condition=lambda p: have_diabetes(p) and on_metformin(p) and (get_a1c(p) is not None and get_a1c(p) >= 7.0),
+        when=((("rxddrug", "has_drug", "metformin"), ("lbxgh", "ge", 7.0)),),
         recommendation="Add a second-line agent guided by comorbidities: GLP-1 RA if weight/CV; SGLT2i if CKD/HF; else consider DPP-4, TZD, SU, or insulin as appropriate.",
         dosage="Choose agent-specific standard starting dose and titration (examples: empagliflozin 10 mg daily; semaglutide start 0.25 mg weekly; pioglitazone 15–30 mg daily).",
         dosage_reason="Add therapy using agents with organ benefit where indicated; start low and titrate per label and patient renal/hepatic status.",
@@ -202,7 +664,7 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_INSULIN_ADDON_GLP1",
         description="Insulin-treated patients with suboptimal control -> consider adding GLP-1 RA.",
-        condition=lambda p: have_diabetes(p) and on_insulin(p) and (get_a1c(p) is not None and get_a1c(p) >= 7.5),
+        when=((("diq050", "flag", True), ("lbxgh", "ge", 7.5)),),
         recommendation="Consider adding a GLP-1 RA to basal insulin to improve A1C and reduce weight/hypoglycemia risk.",
         dosage="GLP-1 RA example: liraglutide 0.6 mg daily → increase to 1.2–1.8 mg daily per tolerance or semaglutide weekly titration; reduce basal insulin dose when adding to reduce hypoglycemia risk.",
         dosage_reason="GLP-1 RAs on top of basal insulin can reduce A1C and insulin requirements; initial basal dose reduction recommended to decrease hypoglycemia risk.",
@@ -215,7 +677,7 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_MASLD",
         description="MASLD/MASH with overweight/obesity -> consider GLP-1 RA or dual GIP/GLP-1 RA.",
-        condition=lambda p: have_diabetes(p) and truthy_flag(p.get("mcq160l")) and (get_bmi(p) is not None and get_bmi(p) >= 25.0),
+        when=((("mcq160l", "flag", True), ("bmi", "ge", 25.0)),),
         recommendation="Consider GLP-1 RA (e.g., semaglutide) or dual GIP/GLP-1 RA; for biopsy-proven MASH consider pioglitazone ± GLP-1 RA.",
         dosage="Pioglitazone: typical 15–30 mg daily; semaglutide per weekly titration. Follow specialist guidance for MASH management.",
         dosage_reason="Some agents improve hepatic steatosis and fibrosis markers; dosing follows product labeling and specialist recommendations.",
@@ -228,7 +690,7 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_COST_CONSIDER",
         description="If cost or access barrier flagged -> propose lower-cost options with warnings.",
-        condition=lambda p: have_diabetes(p) and truthy_flag(p.get("cost_barrier")),
+        when=((("cost_barrier", "flag", True),),),
         recommendation="Consider lower-cost options (metformin, sulfonylureas, human insulin) with documented warnings about hypoglycemia/weight gain.",
         dosage="Metformin: start 500 mg daily → titrate; Glibenclamide/Glipizide dosing per standard label (e.g., glipizide 5 mg daily); human insulin start 10 units/day or 0.1–0.2 units/kg.",
         dosage_reason="Affordable medications can lower cost burden but may increase hypoglycemia risk or weight; inform patient and monitor closely.",
@@ -241,9 +703,9 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_OVERBASAL_FLAG",
         description="Flag possible over-basalization based on bedtime-to-morning differential or frequent hypoglycemia.",
-        condition=lambda p: have_diabetes(p) and (
-            (safe_num(p.get("bedtime_mgdl")) is not None and safe_num(p.get("morning_mgdl")) is not None and (safe_num(p.get("bedtime_mgdl")) - safe_num(p.get("morning_mgdl")) >= 50))
-            or truthy_flag(p.get("frequent_hypoglycemia"))
+        when=(
+            (("bedtime_delta", "ge", 50.0),),
+            (("frequent_hypoglycemia", "flag", True),),
         ),
         recommendation="Flag possible over-basalization; reassess insulin plan.",
         dosage="Consider reducing basal insulin dose or evaluating prandial insulin needs; individualize changes (e.g., reduce basal by 10–20% if frequent hypoglycemia).",
@@ -257,7 +719,10 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_METFORMIN_FIRST",
         description="Default first-line agent for most adults with T2D without contraindications -> metformin.",
-        condition=lambda p: have_diabetes(p) and not on_metformin(p) and (get_eGFR(p) is None or get_eGFR(p) >= 30.0),
+        when=(
+            (("rxddrug", "lacks_drug", "metformin"), ("vnegfr", "missing", None)),
+            (("rxddrug", "lacks_drug", "metformin"), ("vnegfr", "ge", 30.0)),
+        ),
         recommendation="Initiate metformin unless contraindicated (assess eGFR before starting).",
         dosage="Start metformin 500 mg once daily with food; titrate by 500 mg weekly up to 1500–2000 mg/day as tolerated (usual target 1500 mg/day minimum effective dose; max 2000 mg/day commonly used).",
         dosage_reason="Slow titration reduces GI adverse effects and improves adherence; renal function informs safe dosing.",
@@ -270,13 +735,14 @@ def make_ada_rules() -> List[Rule]:
     rules.append(Rule(
         id="R_FALLBACK",
         description="Fallback rule when no specific ADA rule matches.",
-        condition=lambda p: True,
+        when=((),),
         recommendation="Maintain lifestyle therapy and monitor. No specific pharmacologic change triggered by available inputs.",
         dosage="No medication change recommended.",
         dosage_reason="Insufficient data to trigger ADA 2025 rule.",
         priority=9999,
         guideline_ref="General",
-        guideline_text="Used when patient data does not match ADA decision pathways."
+        guideline_text="Used when patient data does not match ADA decision pathways.",
+        requires_diabetes=False
     ))
 
     return rules
@@ -0,0 +1,120 @@
+import pytest
+
+from engine import get_engine
+
+
+def fired_ids(patient):
+    _, expl = get_engine().evaluate(patient)
+    return [e["id"] for e in expl]
+
+
+def test_severe_hyperglycemia_suppresses_add_on():
+    ids = fired_ids({"diq010": 1, "lbxgh": 11.0, "rxddrug": "metformin"})
+    assert ids == ["R_INSULIN_SEVERE"]
+    assert "R_ADD_ON_METFORMIN" not in ids
+
+
+def test_exclusive_rule_keeps_same_priority_rules():
+    ids = fired_ids({"diq010": 1, "vnegfr": 25.0, "bmi": 33.0})
+    assert ids == ["R_METFORMIN_CONTRA", "R_CKD"]
+
+
+def test_missing_markers_do_not_raise():
+    pd = pytest.importorskip("pandas")
+    assert fired_ids({"diq010": pd.NA}) == ["R_FALLBACK"]
+    assert fired_ids({"diq010": 1, "mcq160b": pd.NA}) == ["R_METFORMIN_FIRST"]
+    assert fired_ids({"diq010": 1, "rxddrug": pd.NA}) == ["R_METFORMIN_FIRST"]
+    assert fired_ids({"diq010": 1, "mcq160b": float("nan"), "rxddrug": float("nan")}) == ["R_METFORMIN_FIRST"]
+
+
+def test_evaluate_batch_matches_evaluate_on_nullable_dtypes():
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame({
+        "diq010": [1, 1, None, 1, 1],
+        "mcq160b": [None, 1, 1, 0, None],
+        "lbxgh": [11.0, None, 8.0, 7.5, 6.0],
+        "vnegfr": [None, 25.0, None, 45.0, None],
+        "bmi": [None, 31.0, 40.0, 22.0, 35.0],
+        "rxddrug": [None, "metformin", "insulin", None, "Metformin HCl"],
+        "catabolic_signs": [None, True, True, False, None],
+    }).convert_dtypes()
+    engine = get_engine()
+    fired = engine.evaluate_batch(df)
+    for i, row in enumerate(df.to_dict("records")):
+        expected = [e["id"] for e in engine.evaluate(row)[1]]
+        assert list(fired.columns[fired.iloc[i].to_numpy()]) == expected
+
+
+def test_evaluate_batch_matches_evaluate_on_numeric_flag_columns():
+    pd = pytest.importorskip("pandas")
+    nan = float("nan")
+    # NHANES-style codes: 1 = yes, 2 = no, NaN = not asked
+    df = pd.DataFrame({
+        "diq010": [1.0, 1.0, 2.0, 1.0, nan, 1.0],
+        "diq050": [1, 2, 1, 1, 2, 1],
+        "mcq160b": [nan, 1.0, 1.0, 2.0, nan, 0.0],
+        "mcq160c": [True, False, True, False, False, True],
+        "catabolic_signs": [False, True, True, False, False, False],
+        "lbxgh": [7.6, nan, 8.0, 11.5, 6.0, 7.0],
+        "lbxsgl": [0.0, nan, 310.0, nan, 0.0, 150.0],
+        "lbxglu": [320.0, 305.0, nan, 90.0, nan, 0.0],
+        "bmi": [nan, 31.0, 40.0, 22.0, 35.0, 29.0],
+    })
+    engine = get_engine()
+    fired = engine.evaluate_batch(df)
+    for i, row in enumerate(df.to_dict("records")):
+        expected = [e["id"] for e in engine.evaluate(row)[1]]
+        assert list(fired.columns[fired.iloc[i].to_numpy()]) == expected
+
+
+@pytest.mark.parametrize("meds", ["MetforminER", "metformin500mg", "nometformin", "Glyburide; Metformin HCl"])
+def test_medication_match_is_substring(meds):
+    assert "R_METFORMIN_FIRST" not in fired_ids({"diq010": 1, "rxddrug": meds})
+
+
+def test_ckd_rule_resolves_wording_by_egfr():
+    recs, expl = get_engine().evaluate({"diq010": 1, "vnegfr": 25, "urxums": 40})
+    assert [e["id"] for e in expl].count("R_CKD") == 1
+    assert any(r.startswith("Prefer GLP-1") for r in recs)
+    recs, _ = get_engine().evaluate({"diq010": 1, "vnegfr": 45})
+    assert recs[0].startswith("Use SGLT2 inhibitor")
+
+
+def test_compiled_dispatch_matches_interpreted():
+    from engine import ExpertEngine, make_ada_rules
+
+    compiled = ExpertEngine(make_ada_rules())
+    interpreted = ExpertEngine(make_ada_rules(), compiled=False)
+    patients = [
+        {"diq010": 1, "lbxgh": 11.0, "vnegfr": 25},
+        {"diq010": 1, "vnegfr": 25, "bmi": 33, "urxums": 40},
+        {"diq010": 1, "vnegfr": 45, "mcq160b": "yes", "rxddrug": "Metformin", "lbxgh": "8"},
+        {"diq010": 1, "diq050": 1, "lbxgh": 7.5, "bedtime_mgdl": 220, "morning_mgdl": 150},
+        {"diq010": 0, "bmi": 40},
+        {},
+    ]
+    for p in patients:
+        assert compiled.evaluate(p) == interpreted.evaluate(p)
+
+
+def test_explanations_are_shared_and_read_only():
+    engine = get_engine()
+    _, first = engine.evaluate({"diq010": 1, "bmi": 33})
+    _, second = engine.evaluate({"diq010": 1, "bmi": 35})
+    assert first[0] is second[0]
+    with pytest.raises(TypeError):
+        first[0]["id"] = "changed"
+    with pytest.raises(TypeError):
+        first[0].update(id="changed")
+
+
+def test_evaluate_output_round_trips_through_json_and_pickle():
+    import json
+    import pickle
+
+    result = get_engine().evaluate({"diq010": 1, "vnegfr": 25, "bmi": 33})
+    recs, expl = json.loads(json.dumps(result))
+    assert recs == result[0] and expl == result[1]
+    assert pickle.loads(pickle.dumps(result)) == result
+    patient = {"diq010": 1, "bmi": 33}
+    assert pickle.loads(pickle.dumps(get_engine())).evaluate(patient) == get_engine().evaluate(patient)